@@ -7,13 +7,16 @@ Main entry point for running the web crawler
 import os
 import sys
 import yaml
+import queue
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 import argparse
 from urllib.parse import urlparse
 from scrapy.crawler import CrawlerProcess
 from scrapy.utils.project import get_project_settings
-from crawler import SiteSpider
+from crawler import SiteSpider, expand_domains
+from config_loader import load_crawler_config
 
 def setup_logging(config, verbose=False):
     """Setup logging configuration"""
@@ -31,11 +34,17 @@ def setup_logging(config, verbose=False):
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setFormatter(formatter)
     
+    # Hand records to a background listener thread so file and console
+    # writes never block the Twisted reactor thread
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    
     # Configure root logger
     root_logger = logging.getLogger()
     root_logger.setLevel(log_level)
-    root_logger.addHandler(file_handler)
-    root_logger.addHandler(console_handler)
+    root_logger.addHandler(QueueHandler(log_queue))
     
     # Keep Scrapy noisy modules at INFO even when verbose
     logging.getLogger('scrapy').setLevel(logging.INFO)
@@ -47,9 +56,9 @@ def setup_logging(config, verbose=False):
 def load_config(config_file='config.yml'):
     """Load configuration from YAML file"""
     try:
-        with open(config_file, 'r') as f:
-            config = yaml.safe_load(f)
-        return config['crawler']
+        # Copy: the parsed section is shared with the middlewares and
+        # pipelines, and main() overrides keys like base_url
+        return dict(load_crawler_config(config_file))
     except FileNotFoundError:
         print(f"Configuration file {config_file} not found!")
         sys.exit(1)
@@ -70,6 +79,10 @@ def extract_domain_from_url(url):
     parsed = urlparse(url)
     return parsed.netloc.lower()
 
+def should_abort_playwright_request(request):
+    """Skip browser subresources the crawler never reads (images, fonts, media)"""
+    return request.resource_type in ('image', 'font', 'media')
+
 def update_scrapy_settings(config, use_playwright=False):
     """Update Scrapy settings based on configuration"""
     settings = get_project_settings()
@@ -81,11 +94,50 @@ def update_scrapy_settings(config, use_playwright=False):
     settings.set('DOWNLOAD_DELAY', config.get('delay_between_requests', 2.0))
     settings.set('DEPTH_LIMIT', config.get('max_depth', 3))
     
+    # AutoThrottle - adapt per-domain delay/concurrency to observed latency
+    autothrottle = config.get('autothrottle', {})
+    settings.set('AUTOTHROTTLE_ENABLED', autothrottle.get('enabled', True))
+    settings.set('AUTOTHROTTLE_START_DELAY', autothrottle.get('start_delay', 0.5))
+    settings.set('AUTOTHROTTLE_MAX_DELAY', autothrottle.get('max_delay', 10.0))
+    settings.set('AUTOTHROTTLE_TARGET_CONCURRENCY', autothrottle.get('target_concurrency', 1.0))
+    
+    # Hand out requests by downloader slot load so one slow domain does not
+    # starve the others on multi-domain crawls
+    settings.set('SCHEDULER_PRIORITY_QUEUE', 'scrapy.pqueues.DownloaderAwarePriorityQueue')
+    
+    # Frontier order: BFS uses FIFO queues, DFS keeps Scrapy's LIFO default
+    if config.get('crawl_order', 'dfs').lower() == 'bfs':
+        settings.set('DEPTH_PRIORITY', 1)
+        settings.set('SCHEDULER_DISK_QUEUE', 'scrapy.squeues.PickleFifoDiskQueue')
+        settings.set('SCHEDULER_MEMORY_QUEUE', 'scrapy.squeues.FifoMemoryQueue')
+    
     # Timeout settings - Use improved timeouts
     timeout_settings = config.get('timeout_settings', {})
     settings.set('DOWNLOAD_TIMEOUT', timeout_settings.get('request_timeout', 120))
     settings.set('DOWNLOAD_WARNSIZE', 33554432)  # 32MB
-    settings.set('DOWNLOAD_MAXSIZE', 1073741824)  # 1GB
+    # Abort oversized bodies mid-stream instead of downloading then discarding
+    settings.set('DOWNLOAD_MAXSIZE', int(config.get('max_file_size_mb', 50)) * 1024 * 1024)
+    
+    # Connection reuse - let the per-domain limit govern concurrency and
+    # cache DNS lookups across the crawl
+    network = config.get('network', {})
+    settings.set('CONCURRENT_REQUESTS_PER_IP', 0)
+    settings.set('DNSCACHE_ENABLED', True)
+    settings.set('DNSCACHE_SIZE', network.get('dns_cache_size', 100000))
+    settings.set('DNS_RESOLVER', 'scrapy.resolver.CachingThreadedResolver')
+    settings.set('DNS_TIMEOUT', network.get('dns_timeout', 5))
+    # DNS resolution runs in the reactor thread pool; widen it for crawls
+    # that fan out over many hosts
+    settings.set('REACTOR_THREADPOOL_MAXSIZE', network.get('reactor_threadpool_maxsize', 32))
+    
+    # HTTP cache - off for bulk crawls (every body would be written to disk
+    # twice); DBM keeps it to one file instead of a directory per response
+    http_cache = config.get('http_cache', {})
+    settings.set('HTTPCACHE_ENABLED', http_cache.get('enabled', False))
+    if http_cache.get('enabled', False):
+        settings.set('HTTPCACHE_STORAGE', 'scrapy.extensions.httpcache.DbmCacheStorage')
+        settings.set('HTTPCACHE_DIR', http_cache.get('dir', 'httpcache'))
+        settings.set('HTTPCACHE_EXPIRATION_SECS', http_cache.get('expiration_secs', 0))
     
     # Retry settings
     settings.set('RETRY_TIMES', config.get('max_retries', 5))
@@ -96,10 +148,24 @@ def update_scrapy_settings(config, use_playwright=False):
     settings.set('FILES_STORE', output_dir)
     settings.set('IMAGES_STORE', output_dir)
     
+    # Serialize JSON Lines feeds with orjson
+    settings.set('FEED_EXPORTERS', {
+        'jsonlines': 'exporters.OrjsonLinesItemExporter',
+        'jsonl': 'exporters.OrjsonLinesItemExporter',
+    })
+    settings.set('FEED_EXPORT_ENCODING', 'utf-8')
+    
     # Disable verbose logging to prevent content logging
     settings.set('LOG_LEVEL', 'INFO')
     settings.set('LOG_ENABLED', True)
     
+    # HTTP/2 multiplexes concurrent requests to a host over one connection
+    # (opt-in; requires Twisted's http2 extra)
+    if config.get('http2', False) and not use_playwright:
+        settings.set('DOWNLOAD_HANDLERS', {
+            'https': 'scrapy.core.downloader.handlers.http2.H2DownloadHandler',
+        })
+    
     # Playwright settings for SPA support
     if use_playwright:
         settings.set('DOWNLOAD_HANDLERS', {
@@ -122,6 +188,11 @@ def update_scrapy_settings(config, use_playwright=False):
             ]
         })
         
+        # Share one browser context across the crawl instead of one per page
+        settings.set('PLAYWRIGHT_MAX_CONTEXTS', 1)
+        settings.set('PLAYWRIGHT_MAX_PAGES_PER_CONTEXT', config.get('concurrent_requests', 2))
+        settings.set('PLAYWRIGHT_ABORT_REQUEST', should_abort_playwright_request)
+        
         # Playwright timeout settings
         settings.set('PLAYWRIGHT_DEFAULT_NAVIGATION_TIMEOUT', timeout_settings.get('page_load_timeout', 60) * 1000)
         settings.set('PLAYWRIGHT_PAGE_METHODS_TIMEOUT', timeout_settings.get('javascript_timeout', 30) * 1000)
@@ -162,23 +233,14 @@ def run_crawler(config, custom_url=None, use_playwright=False, verbose=False):
     if custom_url:
         start_urls = [custom_url]
         # Extract domain from custom URL and add to allowed domains
-        custom_domain = extract_domain_from_url(custom_url)
-        allowed_domains.add(custom_domain)
-        # Also add www variant
-        if not custom_domain.startswith('www.'):
-            allowed_domains.add(f'www.{custom_domain}')
-        else:
-            allowed_domains.add(custom_domain[4:])  # Remove www.
+        allowed_domains.add(extract_domain_from_url(custom_url))
     else:
         start_urls = [config.get('base_url')]
         if config.get('base_url'):
-            base_domain = extract_domain_from_url(config.get('base_url'))
-            allowed_domains.add(base_domain)
-            # Also add www variant
-            if not base_domain.startswith('www.'):
-                allowed_domains.add(f'www.{base_domain}')
-            else:
-                allowed_domains.add(base_domain[4:])  # Remove www.
+            allowed_domains.add(extract_domain_from_url(config.get('base_url')))
+    
+    # Also allow the www./bare variant of every domain
+    allowed_domains = expand_domains(allowed_domains)
     
     # Prepare spider arguments
     spider_args = {
@@ -190,7 +252,8 @@ def run_crawler(config, custom_url=None, use_playwright=False, verbose=False):
         'max_pages_per_domain': config.get('max_pages_per_domain', 100),
         'max_file_size_mb': config.get('max_file_size_mb', 50),
         'max_retries': config.get('max_retries', 5),
-        'use_playwright': use_playwright
+        'use_playwright': use_playwright,
+        'config': config
     }
     
     # Start crawler process
@@ -231,21 +294,9 @@ def main():
     
     # Determine allowed domains for display
     allowed_domains = []
-    if args.url:
-        custom_domain = extract_domain_from_url(args.url)
-        allowed_domains.append(custom_domain)
-        if not custom_domain.startswith('www.'):
-            allowed_domains.append(f'www.{custom_domain}')
-        else:
-            allowed_domains.append(custom_domain[4:])
-    else:
-        if config.get('base_url'):
-            base_domain = extract_domain_from_url(config.get('base_url'))
-            allowed_domains.append(base_domain)
-            if not base_domain.startswith('www.'):
-                allowed_domains.append(f'www.{base_domain}')
-            else:
-                allowed_domains.append(base_domain[4:])
+    display_url = args.url or config.get('base_url')
+    if display_url:
+        allowed_domains = sorted(expand_domains([extract_domain_from_url(display_url)]))
     
     # Print configuration summary
     print("=" * 50)
@@ -254,6 +305,7 @@ def main():
     print(f"Base URL: {config.get('base_url')}")
     print(f"Allowed Domains: {', '.join(allowed_domains)}")
     print(f"Max Depth: {config.get('max_depth', 3)}")
+    print(f"Crawl Order: {config.get('crawl_order', 'dfs').upper()}")
     print(f"Max Pages per Domain: {config.get('max_pages_per_domain', 100)}")
     print(f"Max Retries: {config.get('max_retries', 5)}")
     print(f"Page Download Types: {', '.join(config.get('page_download_types', ['html']))}")
@@ -0,0 +1,27 @@
+"""
+Shared config.yml loader
+"""
+
+import os
+import yaml
+
+
+# path -> (mtime_ns, parsed 'crawler' section), shared by the app, the
+# middlewares and the pipelines
+_CONFIG_CACHE = {}
+
+
+def load_crawler_config(path='config.yml'):
+    """
+    Return the 'crawler' section of a config file, re-parsing it only when
+    the file changes. The returned dict is shared: treat it as read-only.
+    """
+    mtime = os.stat(path).st_mtime_ns
+    cached = _CONFIG_CACHE.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(path, 'rb') as f:
+        # libyaml-backed loader when available, pure-Python otherwise
+        config = yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))['crawler']
+    _CONFIG_CACHE[path] = (mtime, config)
+    return config
@@ -1,10 +1,168 @@
 import scrapy
 import re
-import yaml
 import logging
 import asyncio
-from urllib.parse import urljoin, urldefrag, urlparse
+import collections
+import functools
+import hashlib
+import math
+from urllib.parse import urljoin, urldefrag, urlsplit
 from scrapy.exceptions import DropItem
+from w3lib.url import canonicalize_url
+
+# Small URL caches: enough for the nav/footer links repeated on every page
+# of a site, without keeping every candidate URL string alive (the visited
+# set is a Bloom filter precisely so full URLs aren't stored)
+@functools.lru_cache(maxsize=4096)
+def _netloc(url):
+    """Return the lowercased netloc of a URL (cached, URLs repeat across pages)"""
+    return urlsplit(url).netloc.lower()
+
+@functools.lru_cache(maxsize=4096)
+def url_fingerprint(url):
+    """
+    Return a 16-byte fingerprint of the canonical form of a URL, so aliases
+    differing only in query-parameter order or fragment collide
+    """
+    return hashlib.blake2b(canonicalize_url(url).encode('utf-8'), digest_size=16).digest()
+
+# hrefs that never lead to a crawlable page: same-page fragments and
+# non-HTTP schemes (compared against the lowercased start of the href)
+_SKIP_HREF_PREFIXES = ('#', 'javascript:', 'mailto:', 'tel:', 'data:')
+
+def _url_base(url):
+    """
+    Split a page URL into the (origin, directory) prefixes used by
+    _fast_urljoin, or (None, None) when its path has dot or empty segments
+    that urljoin would normalise
+    """
+    parts = urlsplit(url)
+    if '/.' in parts.path or '//' in parts.path:
+        return None, None
+    origin = f"{parts.scheme}://{parts.netloc}"
+    return origin, origin + (parts.path[:parts.path.rfind('/') + 1] or '/')
+
+def _fast_urljoin(base_url, origin, directory, href):
+    """
+    urljoin specialised for the common href shapes (absolute http(s),
+    root-relative and plain relative paths); anything urljoin would
+    normalise (dot segments, empty params/query, embedded tabs/newlines,
+    scheme-relative, query-only or fragment-only hrefs) falls back to urljoin,
+    as does a base that _url_base could not split (origin is None)
+    """
+    if (origin is None or not href or href[0] in '.?#' or href[-1] in '?#' or '/.' in href or ';' in href
+            or '?#' in href or '\t' in href or '\n' in href or '\r' in href):
+        return urljoin(base_url, href)
+    if href.startswith(('http://', 'https://')):
+        # Absolute URLs need a non-empty netloc to be returned unchanged
+        rest = href.partition('//')[2]
+        return href if rest[:1] not in ('', '/', '?', '#') else urljoin(base_url, href)
+    if href[0] == '/':
+        return urljoin(base_url, href) if href[:2] == '//' else origin + href
+    if href[0].isalnum() and '//' not in href and ':' not in href.partition('/')[0].partition('?')[0].partition('#')[0]:
+        return directory + href
+    return urljoin(base_url, href)
+
+def expand_domains(domains):
+    """Return the lowercased domains together with their www./bare variants"""
+    expanded = set()
+    for domain in domains:
+        domain = domain.lower()
+        expanded.add(domain)
+        expanded.add(domain[4:] if domain.startswith('www.') else f'www.{domain}')
+    return frozenset(expanded)
+
+def content_digest(body, algorithm='blake2b'):
+    """Hex digest of a response body, used as the content-dedup key"""
+    if algorithm == 'blake2b':
+        return hashlib.blake2b(body, digest_size=16).hexdigest()
+    return hashlib.new(algorithm, body).hexdigest()
+
+class BloomFilter:
+    """
+    Fixed-memory set of seen fingerprints: uniformly distributed digests of
+    at least 16 bytes (e.g. url_fingerprint, content digests).
+    
+    Membership is probabilistic: a fingerprint that was added is always
+    reported as seen, while an unseen one is wrongly reported as seen with
+    probability of roughly false_positive_rate (as long as expected_items
+    holds).
+    """
+    
+    def __init__(self, expected_items, false_positive_rate=0.001):
+        expected_items = max(int(expected_items), 1)
+        self.capacity = expected_items
+        num_bits = math.ceil(-expected_items * math.log(false_positive_rate) / (math.log(2) ** 2))
+        self.num_bits = num_bits
+        self.num_hashes = max(1, round(num_bits / expected_items * math.log(2)))
+        self.bits = bytearray((num_bits + 7) // 8)
+        self.count = 0
+    
+    def _positions(self, fingerprint):
+        """Bit positions for a fingerprint (double hashing over its two halves)"""
+        h1 = int.from_bytes(fingerprint[:8], 'little')
+        h2 = int.from_bytes(fingerprint[8:16], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+    
+    def __contains__(self, fingerprint):
+        bits = self.bits
+        for pos in self._positions(fingerprint):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+    
+    def add(self, fingerprint):
+        """Add a fingerprint; counts it (and returns True) if any of its bits was unset"""
+        bits = self.bits
+        new = False
+        for pos in self._positions(fingerprint):
+            mask = 1 << (pos & 7)
+            if not bits[pos >> 3] & mask:
+                bits[pos >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+    
+    def __len__(self):
+        return self.count
+
+class ScalableBloomFilter:
+    """
+    Bloom filter that grows instead of degrading once its capacity is used up.
+    
+    Adds a new, larger BloomFilter slice (growth x the previous capacity)
+    whenever the current one is full. Each slice gets a tighter error rate so
+    the compounded false-positive rate stays below error_rate.
+    """
+    
+    def __init__(self, initial_capacity, error_rate=1e-6, growth=2, tightening=0.5):
+        self.error_rate = error_rate
+        self.growth = growth
+        self.tightening = tightening
+        self.filters = [BloomFilter(initial_capacity, error_rate * (1 - tightening))]
+    
+    def __contains__(self, fingerprint):
+        for bloom in reversed(self.filters):
+            if fingerprint in bloom:
+                return True
+        return False
+    
+    def add(self, fingerprint):
+        """Add a fingerprint unless it is already (probably) present"""
+        if fingerprint in self:
+            return False
+        current = self.filters[-1]
+        if current.count >= current.capacity:
+            current = BloomFilter(
+                current.capacity * self.growth,
+                self.error_rate * (1 - self.tightening) * self.tightening ** len(self.filters)
+            )
+            self.filters.append(current)
+        return current.add(fingerprint)
+    
+    def __len__(self):
+        return sum(len(bloom) for bloom in self.filters)
 
 class CrawlItem(scrapy.Item):
     url = scrapy.Field()
@@ -12,10 +170,13 @@ class CrawlItem(scrapy.Item):
     content_type = scrapy.Field()
     body = scrapy.Field()  # optional; or store to disk in pipeline
     file_urls = scrapy.Field()  # for media pipeline
+    file_paths = scrapy.Field()  # set by FileDownloadPipeline
     image_urls = scrapy.Field()
     title = scrapy.Field()
     depth = scrapy.Field()
     domain = scrapy.Field()
+    domain_folder = scrapy.Field()  # set by ValidationPipeline
+    url_path = scrapy.Field()  # set by ValidationPipeline
     content_hash = scrapy.Field()  # Add content hash field
 
     def __repr__(self):
@@ -35,27 +196,62 @@ class CrawlItem(scrapy.Item):
 class SiteSpider(scrapy.Spider):
     name = "site"
     
+    # Extensions of linked documents queued for the files pipeline
+    FILE_EXTENSIONS = ('.pdf', '.doc', '.docx', '.txt', '.rtf', '.odt')
+    
+    # page_download_types name -> (Content-Type substrings, URL path suffixes)
+    PAGE_TYPES = {
+        'html': (('text/html',), ()),
+        'pdf': (('application/pdf',), ('.pdf',)),
+        'doc': (('application/msword',), ('.doc',)),
+        'docx': (('application/vnd.openxmlformats-officedocument.wordprocessingml.document',), ('.docx',)),
+        'txt': (('text/plain',), ('.txt',)),
+        'xml': (('application/xml', 'text/xml'), ('.xml',)),
+        'json': (('application/json',), ('.json',)),
+        'csv': (('text/csv',), ('.csv',)),
+    }
+    
     def __init__(self, allowed_domains=None, start_urls=None, exclude_patterns=None, 
                  download_file_types=None, page_download_types=None, max_pages_per_domain=None, 
-                 max_file_size_mb=None, max_retries=None, use_playwright=False, *args, **kwargs):
+                 max_file_size_mb=None, max_retries=None, use_playwright=False, config=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         
-        # Load configuration
-        self.load_config()
+        # Parsed 'crawler' section of config.yml, passed in by app.py
+        self.config = config or {}
         
         # Override with provided parameters
         merged_allowed = set(self.config.get('allowed_domains', []) or [])
         if allowed_domains:
             merged_allowed.update(allowed_domains)
         self.allowed_domains = sorted(merged_allowed)
+        # Precomputed lookup for is_allowed_domain
+        self._allowed_exact = expand_domains(self.allowed_domains)
         self.start_urls = start_urls or [self.config.get('base_url', 'https://example.com')]
         self.exclude_patterns = exclude_patterns or self.config.get('exclude_patterns', [])
+        # Union of all exclude patterns, so each URL is scanned once
+        self._exclude_re = (
+            re.compile("|".join(f"(?:{p})" for p in self.exclude_patterns))
+            if self.exclude_patterns else None
+        )
         self.download_file_types = download_file_types or self.config.get('download_file_types', [])
+        self._download_file_types = frozenset(self.download_file_types)
         self.page_download_types = page_download_types or self.config.get('page_download_types', ['html'])
+        # Flatten the configured page types into one lookup each for
+        # should_download_page_type (unknown type names are ignored)
+        active_page_types = [self.PAGE_TYPES[t.lower()] for t in self.page_download_types
+                             if t.lower() in self.PAGE_TYPES]
+        self._page_type_content_types = tuple(ct for cts, _ in active_page_types for ct in cts)
+        self._page_type_extensions = tuple(ext for _, exts in active_page_types for ext in exts)
         self.max_pages_per_domain = max_pages_per_domain or self.config.get('max_pages_per_domain', 100)
         self.max_file_size_mb = max_file_size_mb or self.config.get('max_file_size_mb', 50)
         self.max_retries = max_retries or self.config.get('max_retries', 3)
         self.use_playwright = use_playwright
+        self.content_hash_algorithm = self.config.get('content_hash_algorithm', 'blake2b')
+        # Needs a fixed-length digest of at least 16 bytes (rules out shake_*),
+        # which content_digest's hexdigest() and the dedup Bloom filter rely on
+        if (self.content_hash_algorithm not in hashlib.algorithms_available
+                or hashlib.new(self.content_hash_algorithm).digest_size < 16):
+            raise ValueError(f"Unsupported content_hash_algorithm: {self.content_hash_algorithm}")
         
         # Timeout settings
         self.timeout_settings = self.config.get('timeout_settings', {})
@@ -64,18 +260,41 @@ class SiteSpider(scrapy.Spider):
         self.javascript_timeout = self.timeout_settings.get('javascript_timeout', 30)
         self.request_timeout = self.timeout_settings.get('request_timeout', 120)
         
+        # DOM signal that a rendered page is ready (e.g. '#app [data-hydrated]')
+        self.playwright_wait_selector = self.config.get('playwright_wait_selector', 'body')
+        
+        # Immutable request meta shared by every request the spider yields
+        # (see _new_request_meta for the per-request parts)
+        if self.use_playwright:
+            self._request_meta = {
+                "playwright": True,
+                "playwright_page_goto_kwargs": {
+                    "timeout": self.page_load_timeout * 1000,
+                    "wait_until": "networkidle"
+                },
+                "download_timeout": self.request_timeout
+            }
+        else:
+            self._request_meta = {"download_timeout": self.request_timeout}
+        
         # Track pages per domain
-        self.pages_per_domain = {}
+        self.pages_per_domain = collections.defaultdict(int)
         
-        # Track visited URLs to avoid infinite loops
-        self.visited_urls = set()
+        # Track visited URLs (by url_fingerprint) to avoid infinite loops
+        # (Bloom filter keeps memory flat on large crawls; sized generously
+        # above the page budget)
+        self.visited_urls = ScalableBloomFilter(
+            initial_capacity=max(self.max_pages_per_domain * max(len(self.allowed_domains), 1) * 10, 100000),
+            error_rate=1e-6
+        )
         
         # Track crawling progress
         self.crawled_count = 0
         self.failed_count = 0
         
-        # Track retry attempts per URL
-        self.retry_attempts = {}
+        # Track retry attempts per URL (only while a URL is being retried)
+        self.retry_attempts = collections.defaultdict(int)
+        self.retry_count = 0
         
         self.logger.info(f"Spider initialized with {len(self.start_urls)} start URLs")
         self.logger.info(f"Allowed domains: {self.allowed_domains}")
@@ -85,115 +304,112 @@ class SiteSpider(scrapy.Spider):
         self.logger.info(f"Playwright mode: {self.use_playwright}")
         self.logger.info(f"Timeout settings: {self.timeout_settings}")
     
-    def load_config(self):
-        """Load configuration from YAML file"""
-        try:
-            with open('config.yml', 'r') as f:
-                config = yaml.safe_load(f)
-                self.config = config.get('crawler', {})
-        except FileNotFoundError:
-            self.logger.warning("config.yml not found, using default configuration")
-            self.config = {}
-    
     def should_exclude_url(self, url):
         """Check if URL should be excluded based on patterns"""
-        for pattern in self.exclude_patterns:
-            if re.search(pattern, url):
-                return True
-        return False
+        return self._exclude_re is not None and self._exclude_re.search(url) is not None
     
     def is_allowed_domain(self, url):
         """Check if URL belongs to allowed domains (merge-config aware)."""
-        parsed_url = urlparse(url)
-        domain = parsed_url.netloc.lower()
-        for allowed in self.allowed_domains:
-            a = allowed.lower()
-            if domain == a or domain.endswith('.' + a):
-                return True
-            if a.startswith('www.') and domain == a[4:]:
+        return self._is_allowed_netloc(_netloc(url))
+    
+    def _is_allowed_netloc(self, domain):
+        """Check an already-extracted netloc against allowed domains"""
+        host = domain.rpartition('@')[2].partition(':')[0]  # Drop userinfo and port
+        allowed = self._allowed_exact
+        # Probe the host and each parent domain: a.b.example.com, b.example.com, ...
+        while True:
+            if host in allowed:
                 return True
-        return False
+            dot = host.find('.')
+            if dot == -1:
+                return False
+            host = host[dot + 1:]
     
     def check_domain_limit(self, url):
         """Check if domain has reached page limit"""
-        parsed_url = urlparse(url)
-        domain = parsed_url.netloc.lower()
-        
-        if domain in self.pages_per_domain:
-            if self.pages_per_domain[domain] >= self.max_pages_per_domain:
-                return False
-        
-        return True
+        return self._under_domain_limit(_netloc(url))
+    
+    def _under_domain_limit(self, domain):
+        """Check an already-extracted netloc against the page limit"""
+        return self.pages_per_domain.get(domain, 0) < self.max_pages_per_domain
     
     def increment_domain_count(self, url):
         """Increment page count for domain"""
-        parsed_url = urlparse(url)
-        domain = parsed_url.netloc.lower()
-        self.pages_per_domain[domain] = self.pages_per_domain.get(domain, 0) + 1
+        self._increment_domain(_netloc(url))
     
-    def should_download_page_type(self, content_type, url):
+    def _increment_domain(self, domain):
+        """Increment page count for an already-extracted netloc"""
+        self.pages_per_domain[domain] += 1
+    
+    def _claim_domain_slot(self, domain):
+        """Count a page against the domain's limit; False if the limit is already reached"""
+        count = self.pages_per_domain[domain]
+        if count >= self.max_pages_per_domain:
+            return False
+        self.pages_per_domain[domain] = count + 1
+        return True
+    
+    def should_download_page_type(self, content_type, url, path=None):
         """Check if page type should be downloaded based on configuration"""
         if not self.page_download_types:
             return True  # Download all if no specific types configured
         
         # Check content type
         ct = content_type.lower()
+        if any(s in ct for s in self._page_type_content_types):
+            return True
         
-        # Check file extension
-        parsed_url = urlparse(url)
-        path = parsed_url.path.lower()
-        
-        for page_type in self.page_download_types:
-            page_type = page_type.lower()
-            
-            # Check content type matches
-            if page_type == 'html' and 'text/html' in ct:
-                return True
-            elif page_type == 'pdf' and ('application/pdf' in ct or path.endswith('.pdf')):
-                return True
-            elif page_type == 'doc' and ('application/msword' in ct or path.endswith('.doc')):
-                return True
-            elif page_type == 'docx' and ('application/vnd.openxmlformats-officedocument.wordprocessingml.document' in ct or path.endswith('.docx')):
-                return True
-            elif page_type == 'txt' and ('text/plain' in ct or path.endswith('.txt')):
-                return True
-            elif page_type == 'xml' and ('application/xml' in ct or 'text/xml' in ct or path.endswith('.xml')):
-                return True
-            elif page_type == 'json' and ('application/json' in ct or path.endswith('.json')):
-                return True
-            elif page_type == 'csv' and ('text/csv' in ct or path.endswith('.csv')):
-                return True
+        # Check file extension (callers that already split the URL pass the
+        # lowercased path)
+        if path is None:
+            path = urlsplit(url).path.lower()
+        return path.endswith(self._page_type_extensions)
+    
+    def _resolve_link(self, base_url, origin, directory, href):
+        """
+        Join and defragment an href, then split it once.
         
-        return False
+        Returns (url, netloc, lowercased path), or None if the href is not
+        navigational or the URL matches an exclude pattern.
+        """
+        if href.lstrip()[:11].lower().startswith(_SKIP_HREF_PREFIXES):
+            return None
+        url, _ = urldefrag(_fast_urljoin(base_url, origin, directory, href))
+        if self.should_exclude_url(url):
+            return None
+        parts = urlsplit(url)
+        return url, parts.netloc.lower(), parts.path.lower()
+    
+    def _new_request_meta(self):
+        """
+        Meta for a new request: a shallow copy of the shared template, since
+        Scrapy adds its own keys, plus fresh PageMethods in Playwright mode,
+        since scrapy-playwright stores each method's result on the object
+        """
+        meta = self._request_meta.copy()
+        if self.use_playwright:
+            meta["playwright_page_methods"] = self._playwright_page_methods()
+        return meta
+    
+    def _playwright_page_methods(self):
+        """Page methods that wait on readiness signals instead of fixed sleeps"""
+        from scrapy_playwright.page import PageMethod
+        return [
+            PageMethod("wait_for_selector", self.playwright_wait_selector,
+                       state="attached", timeout=self.javascript_timeout * 1000),
+            PageMethod("wait_for_load_state", "networkidle",
+                       timeout=self.network_idle_timeout * 1000),
+        ]
     
     def start_requests(self):
         """Generate initial requests with optional Playwright support"""
         for url in self.start_urls:
-            if self.use_playwright:
-                yield scrapy.Request(
-                    url=url,
-                    callback=self.parse,
-                    meta={
-                        "playwright": True,
-                        "playwright_page_methods": [
-                            {"method": "wait_for_load_state", "args": ["networkidle"], "timeout": self.network_idle_timeout * 1000},
-                            {"method": "wait_for_timeout", "args": [self.javascript_timeout * 1000]},
-                        ],
-                        "playwright_page_goto_kwargs": {
-                            "timeout": self.page_load_timeout * 1000,
-                            "wait_until": "networkidle"
-                        },
-                        "download_timeout": self.request_timeout
-                    },
-                    errback=self.handle_error
-                )
-            else:
-                yield scrapy.Request(
-                    url=url, 
-                    callback=self.parse,
-                    meta={"download_timeout": self.request_timeout},
-                    errback=self.handle_error
-                )
+            yield scrapy.Request(
+                url=url,
+                callback=self.parse,
+                meta=self._new_request_meta(),
+                errback=self.handle_error
+            )
     
     def handle_error(self, failure):
         """Handle request errors with retry logic"""
@@ -201,74 +417,67 @@ class SiteSpider(scrapy.Spider):
         self.failed_count += 1
         
         # Track retry attempts
-        if url not in self.retry_attempts:
-            self.retry_attempts[url] = 0
-        
         self.retry_attempts[url] += 1
+        attempt = self.retry_attempts[url]
         
-        self.logger.error(f"Request failed: {url} - {failure.value} (Attempt {self.retry_attempts[url]})")
+        self.logger.error("Request failed: %s - %s (Attempt %d)", url, failure.value, attempt)
         
         # Retry logic for failed requests
-        if self.retry_attempts[url] <= self.max_retries:
+        if attempt <= self.max_retries:
             retry_delay = self.timeout_settings.get('retry_timeout', 10)
-            self.logger.info(f"Retrying {url} in {retry_delay} seconds... (Attempt {self.retry_attempts[url]}/{self.max_retries})")
+            self.logger.info("Retrying %s in %s seconds... (Attempt %d/%d)", url, retry_delay, attempt, self.max_retries)
+            self.retry_count += 1
             
             # Create new request with same parameters
-            if self.use_playwright:
-                return scrapy.Request(
-                    url,
-                    callback=failure.request.callback,
-                    meta={
-                        "playwright": True,
-                        "playwright_page_methods": [
-                            {"method": "wait_for_load_state", "args": ["networkidle"], "timeout": self.network_idle_timeout * 1000},
-                            {"method": "wait_for_timeout", "args": [self.javascript_timeout * 1000]},
-                        ],
-                        "playwright_page_goto_kwargs": {
-                            "timeout": self.page_load_timeout * 1000,
-                            "wait_until": "networkidle"
-                        },
-                        "download_timeout": self.request_timeout
-                    },
-                    errback=self.handle_error,
-                    dont_filter=True
-                )
-            else:
-                return scrapy.Request(
-                    url,
-                    callback=failure.request.callback,
-                    meta={"download_timeout": self.request_timeout},
-                    errback=self.handle_error,
-                    dont_filter=True
-                )
+            return scrapy.Request(
+                url,
+                callback=failure.request.callback,
+                meta=self._new_request_meta(),
+                errback=self.handle_error,
+                dont_filter=True
+            )
         else:
-            self.logger.error(f"Max retries ({self.max_retries}) exceeded for {url}")
+            # Terminal failure: the count is no longer needed
+            del self.retry_attempts[url]
+            self.logger.error("Max retries (%d) exceeded for %s", self.max_retries, url)
     
     def parse(self, response):
         """Parse response and extract links and content"""
+        # A successful response ends any retry sequence for this URL, which
+        # was keyed by the originally requested URL if it was redirected
+        if self.retry_attempts:
+            self.retry_attempts.pop(response.meta.get('redirect_urls', [response.url])[0], None)
+        
         # Check if URL was already visited
-        if response.url in self.visited_urls:
-            self.logger.debug(f"URL already visited: {response.url}")
+        fingerprint = url_fingerprint(response.url)
+        if fingerprint in self.visited_urls:
+            self.logger.debug("URL already visited: %s", response.url)
             return
         
         # Add to visited URLs
-        self.visited_urls.add(response.url)
+        self.visited_urls.add(fingerprint)
         self.crawled_count += 1
         
-        # Check domain limit
-        if not self.check_domain_limit(response.url):
-            self.logger.info(f"Domain limit reached for {urlparse(response.url).netloc}")
+        # Get content type (header bytes are latin-1 per the HTTP spec)
+        ct = response.headers.get("Content-Type", b"").decode('latin-1').lower()
+        is_html = "text/html" in ct
+        
+        # Skip non-allowed content types before doing any other work
+        if not is_html and ct not in self._download_file_types:
+            self.logger.debug("Skipping non-allowed content type: %s for %s", ct, response.url)
             return
         
-        # Increment domain count
-        self.increment_domain_count(response.url)
+        parts = urlsplit(response.url)
+        domain = parts.netloc.lower()
         
-        # Get content type
-        ct = response.headers.get("Content-Type", b"").decode().lower()
+        # Check and increment the domain count in one step
+        if not self._claim_domain_slot(domain):
+            self.logger.debug("Domain limit reached for %s", domain)
+            return
         
         # Check if we should download this page type
-        if not self.should_download_page_type(ct, response.url):
-            self.logger.info(f"Skipping page type not in download list: {response.url} (Content-Type: {ct})")
+        if not self.should_download_page_type(ct, response.url, parts.path.lower()):
+            self.logger.debug("Skipping page type not in download list: %s (Content-Type: %s)", response.url, ct)
             return
         
         # Create item
@@ -277,138 +486,102 @@ class SiteSpider(scrapy.Spider):
             referrer=response.request.headers.get("Referer"),
             content_type=ct,
             depth=response.meta.get('depth', 0),
-            domain=urlparse(response.url).netloc
+            domain=domain
         )
         
-        # Extract title if HTML
-        if "text/html" in ct:
-            title = response.css('title::text').get()
+        # Process HTML content
+        if is_html:
+            # Hash the body here so dedup never needs the bytes; the body itself
+            # rides along only until PageDownloadPipeline has written it to disk
+            item['content_hash'] = content_digest(response.body, self.content_hash_algorithm)
+            item['body'] = response.body
+            
+            # One walk over the parsed lxml tree collects title, links and images
+            title = None
+            hrefs = []
+            img_srcs = []
+            for element in response.selector.root.iter('a', 'img', 'title'):
+                tag = element.tag
+                if tag == 'a':
+                    hrefs.append(element.get('href'))
+                elif tag == 'img':
+                    img_srcs.append(element.get('src'))
+                elif title is None and element.text:
+                    title = element.text
+            
             if title:
                 item['title'] = title.strip()
-        
-        # Store body for content hashing (optional) - but don't log it
-        if "text/html" in ct:
-            item['body'] = response.body
-        
-        # Process HTML content
-        if "text/html" in ct:
-            # Extract and follow links
+            
+            # Single pass over anchors: linked documents go to the files
+            # pipeline, everything else is followed as a page
             links_found = 0
-            for href in response.css("a::attr(href)").getall():
+            file_urls = []
+            origin, directory = _url_base(response.url)
+            for href in hrefs:
                 if href:
-                    u = urljoin(response.url, href)
-                    u, _ = urldefrag(u)  # Remove fragments
-                    
-                    # Check if URL should be excluded
-                    if self.should_exclude_url(u):
+                    # Resolve once; None means a junk href or an exclude pattern match
+                    link = self._resolve_link(response.url, origin, directory, href)
+                    if link is None:
                         continue
+                    u, link_domain, link_path = link
                     
                     # Check if domain is allowed (STRICT domain checking)
-                    if not self.is_allowed_domain(u):
-                        self.logger.debug(f"Skipping external domain: {u}")
+                    if not self._is_allowed_netloc(link_domain):
+                        self.logger.debug("Skipping external domain: %s", u)
+                        continue
+                    
+                    # Downloadable documents (PDF, DOC, TXT, ...)
+                    if link_path.endswith(self.FILE_EXTENSIONS):
+                        file_urls.append(u)
                         continue
                     
                     # Check domain limit
-                    if not self.check_domain_limit(u):
+                    if not self._under_domain_limit(link_domain):
                         continue
                     
                     # Check if already visited
-                    if u in self.visited_urls:
+                    if url_fingerprint(u) in self.visited_urls:
                         continue
                     
                     # Follow the link
-                    if self.use_playwright:
-                        yield response.follow(
-                            u, 
-                            callback=self.parse,
-                            meta={
-                                "playwright": True,
-                                "playwright_page_methods": [
-                                    {"method": "wait_for_load_state", "args": ["networkidle"], "timeout": self.network_idle_timeout * 1000},
-                                    {"method": "wait_for_timeout", "args": [self.javascript_timeout * 1000]},
-                                ],
-                                "playwright_page_goto_kwargs": {
-                                    "timeout": self.page_load_timeout * 1000,
-                                    "wait_until": "networkidle"
-                                },
-                                "download_timeout": self.request_timeout
-                            },
-                            errback=self.handle_error
-                        )
-                    else:
-                        yield response.follow(
-                            u, 
-                            callback=self.parse,
-                            meta={"download_timeout": self.request_timeout},
-                            errback=self.handle_error
-                        )
+                    yield response.follow(
+                        u, 
+                        callback=self.parse,
+                        meta=self._new_request_meta(),
+                        errback=self.handle_error
+                    )
                     
                     links_found += 1
             
-            self.logger.info(f"Found {links_found} links on {response.url} (Total crawled: {self.crawled_count}, Failed: {self.failed_count})")
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("Found %d links on %s (Total crawled: %d, Failed: %d)",
+                                  links_found, response.url, self.crawled_count, self.failed_count)
             
             # Extract image URLs
             image_urls = []
-            for img_src in response.css("img::attr(src)").getall():
+            for img_src in img_srcs:
                 if img_src:
-                    img_url = urljoin(response.url, img_src)
-                    if not self.should_exclude_url(img_url) and self.is_allowed_domain(img_url):
-                        image_urls.append(img_url)
+                    link = self._resolve_link(response.url, origin, directory, img_src)
+                    if link is not None and self._is_allowed_netloc(link[1]):
+                        image_urls.append(link[0])
             
             item["image_urls"] = image_urls
-            
-            # Extract downloadable files
-            file_urls = []
-            
-            # PDF files
-            for link in response.css('a[href$=".pdf"]::attr(href)').getall():
-                if link:
-                    file_url = urljoin(response.url, link)
-                    if not self.should_exclude_url(file_url) and self.is_allowed_domain(file_url):
-                        file_urls.append(file_url)
-            
-            # Other file types based on content type
-            for link in response.css('a::attr(href)').getall():
-                if link:
-                    file_url = urljoin(response.url, link)
-                    if not self.should_exclude_url(file_url) and self.is_allowed_domain(file_url):
-                        # Check for common file extensions
-                        parsed_url = urlparse(file_url)
-                        path = parsed_url.path.lower()
-                        
-                        # Check for common file extensions
-                        if any(path.endswith(ext) for ext in ['.doc', '.docx', '.txt', '.rtf', '.odt']):
-                            file_urls.append(file_url)
-            
             item["file_urls"] = file_urls
         
-        # For non-HTML content, handle as downloadable file
+        # For non-HTML content, handle as downloadable file (content type
+        # was already checked against download_file_types above)
         else:
-            # Check if content type is in allowed download types
-            if ct in self.download_file_types:
-                item["file_urls"] = [response.url]
-            else:
-                # Skip non-allowed content types
-                self.logger.info(f"Skipping non-allowed content type: {ct} for {response.url}")
-                return
+            item["file_urls"] = [response.url]
         
         yield item
     
     def save_file(self, response):
-        """Handle file downloads"""
-        # Check file size
-        content_length = response.headers.get('Content-Length')
-        if content_length:
-            size_mb = int(content_length) / (1024 * 1024)
-            if size_mb > self.max_file_size_mb:
-                self.logger.warning(f"File too large ({size_mb:.2f}MB): {response.url}")
-                return
-        
+        """Handle file downloads (size is capped by DOWNLOAD_MAXSIZE)"""
         # Create item for file download
         item = CrawlItem(
             url=response.url,
             content_type=response.headers.get("Content-Type", b"").decode().lower(),
-            domain=urlparse(response.url).netloc
+            domain=_netloc(response.url)
         )
         item["file_urls"] = [response.url]
         
@@ -417,8 +590,8 @@ class SiteSpider(scrapy.Spider):
     def closed(self, reason):
         """Called when spider is closed"""
         self.logger.info(f"Spider closed: {reason}")
-        self.logger.info(f"Pages crawled per domain: {self.pages_per_domain}")
+        self.logger.info(f"Pages crawled per domain: {dict(self.pages_per_domain)}")
         self.logger.info(f"Total unique URLs visited: {len(self.visited_urls)}")
         self.logger.info(f"Total pages crawled: {self.crawled_count}")
         self.logger.info(f"Total failed requests: {self.failed_count}")
-        self.logger.info(f"Retry attempts: {sum(self.retry_attempts.values())}")
+        self.logger.info(f"Retry attempts: {self.retry_count}")
@@ -0,0 +1,30 @@
+"""
+Custom Scrapy Feed Exporters
+"""
+
+import orjson
+from scrapy.exporters import BaseItemExporter
+
+
+def _orjson_default(obj):
+    """Serialize types orjson does not handle natively"""
+    if isinstance(obj, bytes):
+        return obj.decode('utf-8', errors='replace')
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+class OrjsonLinesItemExporter(BaseItemExporter):
+    """
+    JSON Lines exporter backed by orjson instead of the stdlib json module
+    """
+
+    def __init__(self, file, **kwargs):
+        super().__init__(dont_fail=True, **kwargs)
+        self.file = file
+
+    def export_item(self, item):
+        """Write one item as a single JSON line"""
+        itemdict = dict(self._get_serialized_fields(item))
+        self.file.write(orjson.dumps(itemdict, default=_orjson_default) + b"\n")
@@ -5,9 +5,13 @@ Custom Scrapy Middlewares
 import time
 import random
 import logging
-from urllib.parse import urlparse
+import collections
+from urllib.parse import urlsplit
+from scrapy import signals
 from scrapy.exceptions import NotConfigured
+from twisted.internet.task import deferLater
 import yaml
+from config_loader import load_crawler_config
 
 
 class DynamicSlowdownMiddleware:
@@ -18,8 +22,10 @@ class DynamicSlowdownMiddleware:
     def __init__(self, settings):
         self.settings = settings
         self.logger = logging.getLogger(__name__)
-        self.domain_request_counts = {}
-        self.domain_last_request = {}
+        self.domain_request_counts = collections.defaultdict(int)
+        # Per-domain token bucket: domain -> (tokens, last refill time)
+        self.domain_buckets = {}
+        self.domain_inflight = collections.Counter()
         
         # Load configuration
         self.load_config()
@@ -33,19 +39,46 @@ class DynamicSlowdownMiddleware:
         self.progressive = self.dynamic_slowdown.get('progressive', True)
         self.per_domain = self.dynamic_slowdown.get('per_domain', True)
         
+        # Requests a domain may send back-to-back after being idle
+        self.burst = max(float(self.dynamic_slowdown.get('burst', 1)), 1.0)
+        
+        # Push-back: hard cap on in-flight requests per domain (0 disables)
+        self.max_inflight_per_domain = int(self.dynamic_slowdown.get('max_inflight_per_domain', 4))
+        self.inflight_retry_interval = float(self.dynamic_slowdown.get('inflight_retry_interval', 0.25))
+        
         self.logger.info(f"Dynamic slowdown enabled: {self.min_delay}-{self.max_delay}s range")
     
     @classmethod
     def from_crawler(cls, crawler):
         """Create middleware instance from crawler"""
-        return cls(crawler.settings)
+        middleware = cls(crawler.settings)
+        crawler.signals.connect(middleware.request_left_downloader, signal=signals.request_left_downloader)
+        return middleware
+    
+    def request_left_downloader(self, request, spider):
+        """Release the domain's in-flight slot once the download has finished or failed"""
+        self.release_inflight(request)
+    
+    def release_inflight(self, request):
+        """Release the request's in-flight slot, if it still holds one (safe to call repeatedly)"""
+        domain = request.meta.pop('slowdown_inflight_domain', None)
+        if domain is not None:
+            self.domain_inflight[domain] -= 1
+    
+    def process_response(self, request, response, spider):
+        """Release the slot of requests answered without reaching the downloader (e.g. HTTP cache hits)"""
+        self.release_inflight(request)
+        return response
+    
+    def process_exception(self, request, exception, spider):
+        """Release the slot of requests that failed before or during the download"""
+        self.release_inflight(request)
+        return None
     
     def load_config(self):
         """Load configuration from config.yml"""
         try:
-            with open('config.yml', 'r') as f:
-                config = yaml.safe_load(f)
-            self.dynamic_slowdown = config['crawler'].get('dynamic_slowdown', {})
+            self.dynamic_slowdown = load_crawler_config().get('dynamic_slowdown', {})
         except (FileNotFoundError, KeyError, yaml.YAMLError) as e:
             self.logger.warning(f"Could not load dynamic slowdown config: {e}")
             self.dynamic_slowdown = {'enabled': False}
@@ -70,34 +103,48 @@ class DynamicSlowdownMiddleware:
     def process_request(self, request, spider):
         """Process request and apply dynamic slowdown"""
         # Extract domain from request URL
-        parsed_url = urlparse(request.url)
-        domain = parsed_url.netloc.lower()
+        domain = urlsplit(request.url).netloc.lower()
+        
+        from twisted.internet import reactor
+        
+        # Push back while the domain already has its cap of requests in
+        # flight: re-check after a short wait instead of sending a burst
+        if self.max_inflight_per_domain and 'slowdown_inflight_domain' not in request.meta:
+            if self.domain_inflight[domain] >= self.max_inflight_per_domain:
+                return deferLater(reactor, self.inflight_retry_interval, self.process_request, request, spider)
+            self.domain_inflight[domain] += 1
+            request.meta['slowdown_inflight_domain'] = domain
         
         # Calculate delay for this domain
         delay = self.calculate_delay(domain)
         
         # Track request count for this domain
         if self.per_domain:
-            self.domain_request_counts[domain] = self.domain_request_counts.get(domain, 0) + 1
+            self.domain_request_counts[domain] += 1
         
-        # Check last request time for this domain to avoid too frequent requests
+        # Token bucket refilled at one token per `delay` seconds, holding up
+        # to `burst` tokens. Taking a token up front (the balance may go
+        # negative) reserves a slot, so concurrent requests queue behind
+        # each other instead of all waking at once.
         current_time = time.time()
-        last_request_time = self.domain_last_request.get(domain, 0)
-        time_since_last = current_time - last_request_time
-        
-        # If we need to wait longer, sleep for the remaining time
-        if time_since_last < delay:
-            sleep_time = delay - time_since_last
-            self.logger.debug(f"Dynamic slowdown: sleeping {sleep_time:.2f}s for {domain} "
-                            f"(request #{self.domain_request_counts.get(domain, 1)})")
-            time.sleep(sleep_time)
+        tokens, last_refill = self.domain_buckets.get(domain, (self.burst, current_time))
+        if delay > 0:
+            tokens = min(self.burst, tokens + (current_time - last_refill) / delay) - 1
+            sleep_time = -tokens * delay if tokens < 0 else 0
+        else:
+            tokens, sleep_time = self.burst, 0
+        self.domain_buckets[domain] = (tokens, current_time)
         
-        # Update last request time
-        self.domain_last_request[domain] = time.time()
+        # Log the delay applied (debug: this runs once per request)
+        self.logger.debug("Applied %.2fs delay for %s (request #%d)",
+                          delay, domain, self.domain_request_counts.get(domain, 1))
         
-        # Log the delay applied
-        self.logger.info(f"Applied {delay:.2f}s delay for {domain} "
-                        f"(request #{self.domain_request_counts.get(domain, 1)})")
+        # Wait for the remaining time without blocking the reactor: Scrapy
+        # resumes the middleware chain once the returned Deferred fires
+        if sleep_time > 0:
+            self.logger.debug("Dynamic slowdown: delaying %.2fs for %s (request #%d)",
+                              sleep_time, domain, self.domain_request_counts.get(domain, 1))
+            return deferLater(reactor, sleep_time, lambda: None)
         
         return None  # Continue processing the request
 
@@ -118,6 +165,10 @@ class RandomUserAgentMiddleware:
             'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.1.1 Safari/605.1.15',
             'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Edge/91.0.864.59',
         ]
+        # Pre-encoded header values and a private PRNG, so each request only
+        # picks one (Scrapy's Headers would otherwise re-encode the str)
+        self._user_agents = tuple(ua.encode('latin-1') for ua in self.user_agents)
+        self._rng = random.Random()
         self.logger = logging.getLogger(__name__)
     
     @classmethod
@@ -127,7 +178,7 @@ class RandomUserAgentMiddleware:
     
     def process_request(self, request, spider):
         """Randomly assign user agent to request"""
-        user_agent = random.choice(self.user_agents)
-        request.headers['User-Agent'] = user_agent
-        self.logger.debug(f"Using User-Agent: {user_agent[:50]}...")
+        user_agent = self._rng.choice(self._user_agents)
+        request.headers[b'User-Agent'] = user_agent
+        self.logger.debug("Using User-Agent: %s...", user_agent[:50])
         return None
@@ -1,18 +1,85 @@
 import os
-import json
+import re
+import functools
+import orjson
 import hashlib
 import logging
+import sqlite3
+import threading
 from urllib.parse import urlparse, urljoin
-from scrapy.pipelines.files import FilesPipeline
+from scrapy.pipelines.files import FilesPipeline, FileException
 from scrapy.pipelines.images import ImagesPipeline
 from scrapy.http import Request
 from scrapy.exceptions import DropItem
-import yaml
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
 from datetime import datetime
+from crawler import content_digest, ScalableBloomFilter
+from config_loader import load_crawler_config
 
-class FileDownloadPipeline(FilesPipeline):
+# Per-thread 1 MiB read buffer reused by every calculate_file_hash call
+_hash_buffers = threading.local()
+
+def _open_manifest_db(path, table, columns, indexed_column=None):
+    """Open a SQLite manifest (WAL mode) with an empty table for this crawl"""
+    db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    # Each crawl starts a fresh manifest, like the JSON files exported from it
+    db.execute(f'DROP TABLE IF EXISTS {table}')
+    db.execute(f'CREATE TABLE {table} (url TEXT PRIMARY KEY, {", ".join(columns)})')
+    if indexed_column:
+        db.execute(f'CREATE INDEX {table}_{indexed_column} ON {table} ({indexed_column})')
+    return db
+
+def _export_manifest(rows, columns, manifest_file):
+    """Stream (url, *columns) rows into an indented JSON object keyed by URL"""
+    with open(manifest_file, 'wb') as f:
+        f.write(b'{')
+        separator = b'\n  '
+        for url, *values in rows:
+            entry = orjson.dumps(dict(zip(columns, values)), option=orjson.OPT_INDENT_2)
+            f.write(separator + orjson.dumps(url) + b': ' + entry.replace(b'\n', b'\n  '))
+            separator = b',\n  '
+        f.write(b'}' if separator == b'\n  ' else b'\n}')
+
+@functools.lru_cache(maxsize=65536)
+def _split_url(url):
+    """Split a URL into (domain folder, path without surrounding slashes)"""
+    parsed_url = urlparse(url)
+    return parsed_url.netloc.removeprefix('www.'), parsed_url.path.strip('/')
+
+class BasePipelineMixin:
+    """Config loading and logger setup shared by all pipelines"""
+    
+    # Used when config.yml is missing (shared, treat as read-only)
+    DEFAULT_CONFIG = {}
+    
+    def load_config(self):
+        """Load configuration from YAML file"""
+        try:
+            self.config = load_crawler_config()
+        except FileNotFoundError:
+            self.config = self.DEFAULT_CONFIG
+    
+    def setup_logging(self):
+        """Setup logging for the pipeline"""
+        self.logger = logging.getLogger(__name__)
+
+class FileDownloadPipeline(BasePipelineMixin, FilesPipeline):
     """Custom pipeline for downloading files with hash-based deduplication"""
     
+    DEFAULT_CONFIG = {
+        'storage': {
+            'output_dir': './downloads',
+            'manifest_file': './crawl_manifest.json'
+        },
+        'max_file_size_mb': 50
+    }
+    
+    # Manifest fields, in SQLite column and JSON key order
+    MANIFEST_COLUMNS = ('file_path', 'hash', 'checksum', 'content_type', 'timestamp', 'size')
+    
     @classmethod
     def from_crawler(cls, crawler):
         """Create pipeline instance from crawler"""
@@ -21,32 +88,26 @@ class FileDownloadPipeline(FilesPipeline):
     
     def __init__(self, store_uri, download_func=None, settings=None, crawler=None):
         super().__init__(store_uri, download_func, settings)
-        self.manifest = {}
+        # url -> (sha256, size) captured while the body is still in memory
+        self.downloaded_files = {}
+        # Manifest rows live in SQLite (next to manifest_file) instead of
+        # memory; the JSON manifest is exported once when the spider closes
+        self.manifest_db = None
         self.crawler = crawler
         self.load_config()
         self.setup_logging()
+        self.max_file_size = int(self.config.get('max_file_size_mb', 50)) * 1024 * 1024
         
     def load_config(self):
-        """Load configuration from YAML file"""
-        try:
-            with open('config.yml', 'r') as f:
-                self.config = yaml.safe_load(f)['crawler']
-        except FileNotFoundError:
-            self.config = {
-                'storage': {
-                    'output_dir': './downloads',
-                    'manifest_file': './crawl_manifest.json'
-                },
-                'max_file_size_mb': 50
-            }
-    
-    def setup_logging(self):
-        """Setup logging for the pipeline"""
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+        """Load configuration and compile the exclude patterns"""
+        super().load_config()
+        
+        # Compile the exclude patterns once into a single alternation
+        exclude_patterns = self.config.get('exclude_patterns', [])
+        self._exclude_re = (
+            re.compile("|".join(f"(?:{p})" for p in exclude_patterns))
+            if exclude_patterns else None
         )
-        self.logger = logging.getLogger(__name__)
     
     def get_media_requests(self, item, info):
         """Generate requests for file downloads"""
@@ -64,22 +125,11 @@ class FileDownloadPipeline(FilesPipeline):
     
     def should_exclude_url(self, url):
         """Check if URL should be excluded based on patterns"""
-        exclude_patterns = self.config.get('exclude_patterns', [])
-        
-        for pattern in exclude_patterns:
-            import re
-            if re.search(pattern, url):
-                return True
-        return False
+        return self._exclude_re is not None and self._exclude_re.search(url) is not None
     
     def file_path(self, request, response=None, info=None, *, item=None):
         """Generate file path for downloaded file"""
-        url = request.url
-        parsed_url = urlparse(url)
-        
-        domain = parsed_url.netloc.replace("www.", "")
-        path = parsed_url.path.strip("/")
-        domain_folder = domain
+        domain_folder, path = _split_url(request.url)
         
         if not path:
             path = 'index'
@@ -100,6 +150,15 @@ class FileDownloadPipeline(FilesPipeline):
         filename = f"{path}{ext}" if path != "index" else f"index{ext}"
         return f"{domain_folder}/{filename}"
     
+    def file_downloaded(self, response, request, info, *, item=None):
+        """Persist the file and record its SHA-256 and size from the in-memory body"""
+        # Reject oversized files before they are stored or hashed
+        if len(response.body) > self.max_file_size:
+            raise FileException(f"File exceeds max_file_size_mb ({len(response.body)} bytes): {request.url}")
+        checksum = super().file_downloaded(response, request, info, item=item)
+        self.downloaded_files[request.url] = (hashlib.sha256(response.body).hexdigest(), len(response.body))
+        return checksum
+    
     def item_completed(self, results, item, info):
         """Called when item processing is completed"""
         file_paths = []
@@ -107,107 +166,133 @@ class FileDownloadPipeline(FilesPipeline):
         for success, result in results:
             if success:
                 file_path = result['path']
-                file_paths.append(file_path)
-                
-                # Calculate file hash
-                file_hash = self.calculate_file_hash(result['path'])
                 
-                # Compute file size
-                try:
+                # Use the hash and size taken at download time; files that
+                # were already up to date in the store are read back instead
+                downloaded = self.downloaded_files.pop(result['url'], None)
+                if downloaded:
+                    file_hash, size_bytes = downloaded
+                else:
                     full_path = os.path.join(self.store.basedir, file_path)
-                    size_bytes = os.path.getsize(full_path)
-                except Exception:
-                    size_bytes = 0
+                    try:
+                        size_bytes = os.path.getsize(full_path)
+                    except Exception:
+                        size_bytes = 0
+                    
+                    # Drop stored files over the size limit without hashing them
+                    if size_bytes > self.max_file_size:
+                        self.logger.info(f"Removing oversized file {file_path} ({size_bytes} bytes)")
+                        try:
+                            os.remove(full_path)
+                        except OSError as e:
+                            self.logger.error(f"Error removing oversized file {file_path}: {e}")
+                        continue
+                    
+                    file_hash = self.calculate_file_hash(file_path)
+                
+                file_paths.append(file_path)
                 
                 # Add to manifest
-                self.manifest[item['url']] = {
+                self.record_manifest_entry(item['url'], {
                     'file_path': file_path,
                     'hash': file_hash,
                     'checksum': result.get('checksum', ''),
                     'content_type': item.get('content_type', ''),
                     'timestamp': datetime.now().isoformat(),
                     'size': size_bytes
-                }
+                })
         
         if file_paths:
             item['file_paths'] = file_paths
         
-        # Save manifest periodically
-        self.save_manifest()
-        
         return item
     
     def calculate_file_hash(self, file_path):
         """Calculate SHA-256 hash of file"""
         try:
             full_path = os.path.join(self.store.basedir, file_path)
-            with open(full_path, 'rb') as f:
-                return hashlib.sha256(f.read()).hexdigest()
+            buf = getattr(_hash_buffers, 'buf', None)
+            if buf is None:
+                buf = _hash_buffers.buf = memoryview(bytearray(1 << 20))
+            # Stream the file through the hash without allocating per chunk
+            sha256 = hashlib.sha256()
+            with open(full_path, 'rb', buffering=0) as f:
+                while n := f.readinto(buf):
+                    sha256.update(buf[:n])
+            return sha256.hexdigest()
         except Exception as e:
             self.logger.error(f"Error calculating hash for {file_path}: {e}")
             return ""
     
+    def record_manifest_entry(self, url, entry):
+        """Insert or replace one manifest row (constant cost per item)"""
+        try:
+            if self.manifest_db is None:
+                manifest_file = self.config['storage']['manifest_file']
+                self.manifest_db = _open_manifest_db(
+                    os.path.splitext(manifest_file)[0] + '.db', 'files', self.MANIFEST_COLUMNS
+                )
+            self.manifest_db.execute(
+                f"INSERT OR REPLACE INTO files VALUES (?{', ?' * len(self.MANIFEST_COLUMNS)})",
+                (url, *(entry[column] for column in self.MANIFEST_COLUMNS))
+            )
+        except Exception as e:
+            self.logger.error(f"Error recording manifest entry for {url}: {e}")
+    
     def save_manifest(self):
-        """Save crawl manifest to JSON file"""
+        """Export the crawl manifest to its JSON file"""
         try:
-            manifest_file = self.config['storage']['manifest_file']
-            with open(manifest_file, 'w') as f:
-                json.dump(self.manifest, f, indent=2)
+            rows = ()
+            if self.manifest_db is not None:
+                rows = self.manifest_db.execute(
+                    f"SELECT url, {', '.join(self.MANIFEST_COLUMNS)} FROM files ORDER BY rowid"
+                )
+            _export_manifest(rows, self.MANIFEST_COLUMNS, self.config['storage']['manifest_file'])
         except Exception as e:
             self.logger.error(f"Error saving manifest: {e}")
     
     def close_spider(self, spider):
         """Called when spider is closed"""
         self.save_manifest()
-        self.logger.info(f"Crawl completed. {len(self.manifest)} files downloaded.")
+        file_count = 0
+        if self.manifest_db is not None:
+            file_count = self.manifest_db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+            self.manifest_db.close()
+        self.logger.info(f"Crawl completed. {file_count} files downloaded.")
 
-class ContentHashPipeline:
+class ContentHashPipeline(BasePipelineMixin):
     """Pipeline for content-based deduplication"""
     
     def __init__(self):
-        self.content_hashes = set()
+        # Bloom filter of seen body digests: memory stays at a few bytes per
+        # page, at the cost of dropping roughly one unique page per million
+        # as a false-positive duplicate
+        self.content_hashes = ScalableBloomFilter(initial_capacity=100000, error_rate=1e-6)
         self.load_config()
     
-    def load_config(self):
-        """Load configuration from YAML file"""
-        try:
-            with open('config.yml', 'r') as f:
-                self.config = yaml.safe_load(f)['crawler']
-        except FileNotFoundError:
-            self.config = {}
-    
     def process_item(self, item, spider):
         """Process item and check for content duplication"""
-        if 'body' in item and item['body']:
-            content_hash = hashlib.md5(item['body']).hexdigest()
-            
-            if content_hash in self.content_hashes:
+        # The spider hashes page bodies in parse; only hash here as a fallback
+        content_hash = item.get('content_hash')
+        if not content_hash and item.get('body'):
+            content_hash = content_digest(item['body'], self.config.get('content_hash_algorithm', 'blake2b'))
+        
+        if content_hash:
+            # add() is False when the digest was (probably) seen before
+            if not self.content_hashes.add(bytes.fromhex(content_hash)):
                 raise DropItem(f"Duplicate content found: {item['url']}")
             
-            self.content_hashes.add(content_hash)
             item['content_hash'] = content_hash
         
         return item
 
-class ValidationPipeline:
+class ValidationPipeline(BasePipelineMixin):
     """Pipeline for validating crawled items"""
     
     def __init__(self):
         self.load_config()
         self.setup_logging()
     
-    def load_config(self):
-        """Load configuration from YAML file"""
-        try:
-            with open('config.yml', 'r') as f:
-                self.config = yaml.safe_load(f)['crawler']
-        except FileNotFoundError:
-            self.config = {}
-    
-    def setup_logging(self):
-        """Setup logging for the pipeline"""
-        self.logger = logging.getLogger(__name__)
-    
     def process_item(self, item, spider):
         """Validate item before processing"""
         # Check URL validity
@@ -223,60 +308,92 @@ class ValidationPipeline:
             if 'text/html' not in content_type:
                 raise DropItem(f"Content type not allowed: {content_type}")
         
+        # Split the URL once for the rest of the pipeline chain
+        item['domain_folder'], item['url_path'] = _split_url(item['url'])
+        
         return item
 
-class PageDownloadPipeline:
+class PageDownloadPipeline(BasePipelineMixin):
     """Pipeline for downloading HTML pages with proper directory structure"""
     
+    DEFAULT_CONFIG = {
+        'storage': {
+            'output_dir': './downloads'
+        }
+    }
+    
+    # Bytes hashed and written per step, small enough to stay cache-resident
+    WRITE_CHUNK_SIZE = 256 * 1024
+    
+    # Manifest fields, in SQLite column and JSON key order
+    MANIFEST_COLUMNS = ('file_path', 'hash', 'content_type', 'title', 'depth', 'timestamp', 'size')
+    
     def __init__(self):
         self.load_config()
         self.setup_logging()
-        self.domain_manifests = {}
-        
-    def load_config(self):
-        """Load configuration from YAML file"""
-        try:
-            with open('config.yml', 'r') as f:
-                self.config = yaml.safe_load(f)['crawler']
-        except FileNotFoundError:
-            self.config = {
-                'storage': {
-                    'output_dir': './downloads'
-                }
-            }
+        # domain folder -> its directory under output_dir
+        self.domain_paths = {}
+        # Directories already created this crawl (skips repeat makedirs calls)
+        self.dirs_created = set()
+        # Manifest rows for all domains live in SQLite instead of memory; the
+        # per-domain JSON manifests are exported once when the spider closes
+        self.manifest_db = None
+        # Pages are saved in worker threads; guards the manifest database
+        self.manifest_lock = threading.Lock()
+        # Dedicated pool for page writes and hashing (hashlib releases the GIL),
+        # sized to the CPU count so pages don't queue behind DNS lookups in
+        # the reactor thread pool
+        write_workers = self.config.get('storage', {}).get('write_workers') or os.cpu_count() or 4
+        self.write_pool = ThreadPool(minthreads=1, maxthreads=write_workers, name='PageDownloadPipeline')
     
-    def setup_logging(self):
-        """Setup logging for the pipeline"""
-        self.logger = logging.getLogger(__name__)
+    def open_spider(self, spider):
+        """Start the page write pool"""
+        from twisted.internet import reactor
+        self.write_pool.start()
+        # Pool threads are non-daemon: also stop them on reactor shutdown so
+        # the process can exit when close_spider never runs
+        reactor.addSystemEventTrigger('during', 'shutdown', self.stop_write_pool)
+    
+    def stop_write_pool(self):
+        """Stop the page write pool (safe to call more than once)"""
+        if self.write_pool.started:
+            self.write_pool.stop()
     
     def process_item(self, item, spider):
         """Download HTML pages and save them with proper directory structure"""
         if not item.get('body') or not item.get('url'):
+            item.pop('domain_folder', None)
+            item.pop('url_path', None)
             return item
         
+        # Disk writes and hashing run in the write pool so they don't stall
+        # in-flight requests; Scrapy resumes once the Deferred fires
+        from twisted.internet import reactor
+        return deferToThreadPool(reactor, self.write_pool, self.save_page, item)
+    
+    def save_page(self, item):
+        """Write a page to disk and record it in the domain manifest (runs in a worker thread)"""
         try:
-            # Parse URL to get domain and path
-            parsed_url = urlparse(item['url'])
-            domain = parsed_url.netloc.replace('www.', '')
+            # Domain and path as split by ValidationPipeline
             # Keep domain as-is for folder name (e.g., theciso.org, example.com)
-            domain_folder = domain
+            if 'domain_folder' in item:
+                domain_folder, path = item['domain_folder'], item['url_path']
+            else:
+                domain_folder, path = _split_url(item['url'])
             
             # Create output directory structure
             output_dir = self.config['storage']['output_dir']
             domain_path = os.path.join(output_dir, domain_folder)
-            os.makedirs(domain_path, exist_ok=True)
-            path = parsed_url.path.strip("/")
             # Create directory hierarchy based on URL path
             if path:
                 # Split path into components
                 path_parts = path.split('/')
                 current_path = domain_path
                 
-                # Create subdirectories for each path component
+                # Subdirectories for each path component
                 for part in path_parts[:-1]:  # Exclude the last part (filename)
                     if part:
                         current_path = os.path.join(current_path, part)
-                        os.makedirs(current_path, exist_ok=True)
                 
                 # Determine filename
                 if path_parts[-1]:
@@ -289,24 +406,19 @@ class PageDownloadPipeline:
                 current_path = domain_path
                 filename = 'index.html'
             
+            # Create the whole directory hierarchy in one call
+            self.ensure_dir(current_path)
+            
             # Full file path
             file_path = os.path.join(current_path, filename)
             
-            # Save the HTML content
-            with open(file_path, 'wb') as f:
-                f.write(item['body'])
-            
-            # Calculate file hash
-            file_hash = hashlib.sha256(item['body']).hexdigest()
+            # Save the HTML content and calculate its hash in the same pass
+            file_hash = self.write_page(file_path, item['body'])
             
             # Get relative path for manifest
             relative_path = os.path.relpath(file_path, output_dir)
             
-            # Add to domain manifest
-            if domain_folder not in self.domain_manifests:
-                self.domain_manifests[domain_folder] = {}
-            
-            self.domain_manifests[domain_folder][item['url']] = {
+            entry = {
                 'file_path': relative_path,
                 'hash': file_hash,
                 'content_type': item.get('content_type', ''),
@@ -316,27 +428,83 @@ class PageDownloadPipeline:
                 'size': len(item['body'])
             }
             
-            # Save domain manifest
-            self.save_domain_manifest(domain_folder, domain_path)
+            # Add to domain manifest
+            with self.manifest_lock:
+                self.domain_paths.setdefault(domain_folder, domain_path)
+                self.record_manifest_entry(domain_folder, item['url'], entry)
             
             self.logger.info(f"Downloaded page: {item['url']} -> {relative_path}")
             
         except Exception as e:
             self.logger.error(f"Error downloading page {item['url']}: {e}")
         
+        # The page is on disk now; don't carry the body through the files
+        # pipeline, which holds the item until all its media downloads finish,
+        # nor the internal path parts into the exported items
+        item.pop('body', None)
+        item.pop('domain_folder', None)
+        item.pop('url_path', None)
+        
         return item
     
+    def write_page(self, file_path, body):
+        """Write a page body and return its SHA-256, hashing each chunk as it is written"""
+        sha256 = hashlib.sha256()
+        view = memoryview(body)
+        # Raw file descriptor: each chunk goes straight to os.write without
+        # an intermediate BufferedWriter copy
+        fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            for start in range(0, len(view), self.WRITE_CHUNK_SIZE):
+                chunk = view[start:start + self.WRITE_CHUNK_SIZE]
+                sha256.update(chunk)
+                while chunk:
+                    chunk = chunk[os.write(fd, chunk):]
+        finally:
+            os.close(fd)
+        return sha256.hexdigest()
+    
+    def ensure_dir(self, path):
+        """Create a directory (and its parents) unless this crawl already did"""
+        if path not in self.dirs_created:
+            os.makedirs(path, exist_ok=True)
+            self.dirs_created.add(path)
+    
+    def record_manifest_entry(self, domain_folder, url, entry):
+        """Insert or replace one page row (constant cost per item; caller holds manifest_lock)"""
+        try:
+            if self.manifest_db is None:
+                manifest_db_file = os.path.join(self.config['storage']['output_dir'], 'crawl_manifest.db')
+                self.manifest_db = _open_manifest_db(
+                    manifest_db_file, 'pages', ('domain', *self.MANIFEST_COLUMNS), indexed_column='domain'
+                )
+            self.manifest_db.execute(
+                f"INSERT OR REPLACE INTO pages VALUES (?, ?{', ?' * len(self.MANIFEST_COLUMNS)})",
+                (url, domain_folder, *(entry[column] for column in self.MANIFEST_COLUMNS))
+            )
+        except Exception as e:
+            self.logger.error(f"Error recording manifest entry for {url}: {e}")
+    
     def save_domain_manifest(self, domain_folder, domain_path):
-        """Save manifest file for specific domain"""
+        """Export the manifest file for a specific domain"""
         try:
-            manifest_file = os.path.join(domain_path, 'crawl_manifest.json')
-            with open(manifest_file, 'w') as f:
-                json.dump(self.domain_manifests[domain_folder], f, indent=2)
+            rows = self.manifest_db.execute(
+                f"SELECT url, {', '.join(self.MANIFEST_COLUMNS)} FROM pages WHERE domain = ? ORDER BY rowid",
+                (domain_folder,)
+            )
+            _export_manifest(rows, self.MANIFEST_COLUMNS, os.path.join(domain_path, 'crawl_manifest.json'))
         except Exception as e:
             self.logger.error(f"Error saving domain manifest for {domain_folder}: {e}")
     
     def close_spider(self, spider):
         """Called when spider is closed"""
-        self.logger.info(f"Page download completed. Downloaded pages for {len(self.domain_manifests)} domains.")
-        for domain in self.domain_manifests:
-            self.logger.info(f"Domain {domain}: {len(self.domain_manifests[domain])} pages downloaded")
+        self.stop_write_pool()
+        page_counts = {}
+        if self.manifest_db is not None:
+            for domain, domain_path in self.domain_paths.items():
+                self.save_domain_manifest(domain, domain_path)
+            page_counts = dict(self.manifest_db.execute("SELECT domain, COUNT(*) FROM pages GROUP BY domain"))
+            self.manifest_db.close()
+        self.logger.info(f"Page download completed. Downloaded pages for {len(page_counts)} domains.")
+        for domain, count in page_counts.items():
+            self.logger.info(f"Domain {domain}: {count} pages downloaded")
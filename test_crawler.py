@@ -0,0 +1,30 @@
+"""
+Checks that _fast_urljoin agrees with urljoin
+"""
+
+from urllib.parse import urljoin
+
+import pytest
+
+from crawler import _fast_urljoin, _url_base
+
+
+BASES = [
+    'http://h.com/a/b/c',
+    'http://h.com/a/b/',
+    'http://h.com',
+    'http://h.com/a/../b/c',
+    'http://h.com/a/./c',
+    'http://h.com/a//c',
+    'http://h.com/a/b/.',
+    'http://h.com/a/b/..',
+]
+
+HREFS = ['d', 'd.html', 'x/y.html', '/root.html', 'http://o.com/p', '../up', './here', '?q=1', '#top']
+
+
+@pytest.mark.parametrize('base', BASES)
+@pytest.mark.parametrize('href', HREFS)
+def test_fast_urljoin_matches_urljoin(base, href):
+    origin, directory = _url_base(base)
+    assert _fast_urljoin(base, origin, directory, href) == urljoin(base, href)